@@ -1,6 +1,8 @@
 import json
 import boto3
+import orjson
 import os
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key
 from decimal import Decimal
 from botocore.exceptions import ClientError
@@ -11,13 +13,34 @@ table_name = os.environ.get('DYNAMODB_TABLE')
 bucket_name = os.environ.get('S3_BUCKET_NAME')
 table = dynamodb.Table(table_name)
 
+PRESIGN_WORKERS = 16
+PRESIGN_EXPIRES = 3600
+IMAGE_CACHE_CONTROL = 'public, max-age=3600'
 
-# Helper to convert Decimal to float/int for JSON serialization
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+# Attributes the frontend reads (s3_key is needed to presign image_url); trims the payload only,
+# DynamoDB still bills reads on the full item size
+ITEM_PROJECTION = 'station_id, s3_key, meteo_records, rekognition_data'
+ALL_BY_TIME_INDEX = 'AllByTime'
+ALL_STATIONS_PK = 'ALL'
+LATEST_TIMESTAMP = '#latest'  # Downloader's per-station dedup item, not a data record
+
+
+# Helper to convert Decimal to float for JSON serialization
+def decimal_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def presign_url(s3_key):
+    try:
+        return s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': s3_key, 'ResponseCacheControl': IMAGE_CACHE_CONTROL},
+            ExpiresIn=PRESIGN_EXPIRES
+        )
+    except ClientError:
+        return None
 
 
 def lambda_handler(event, context):
@@ -38,35 +61,36 @@ def lambda_handler(event, context):
         if station_id and station_id != 'all':
             # Query specific station (last 50 records)
             response = table.query(
-                KeyConditionExpression=Key('station_id').eq(station_id),
+                KeyConditionExpression=Key('station_id').eq(station_id) & Key('timestamp').gt(LATEST_TIMESTAMP),
                 ScanIndexForward=False,  # Newest first
-                Limit=50
+                Limit=50,
+                ProjectionExpression=ITEM_PROJECTION
             )
             items = response.get('Items', [])
         else:
-            # Scan all (limit to recent 200 for performance)
-            response = table.scan()
-            # Sort in memory since Scan doesn't sort
-            all_items = response.get('Items', [])
-            items = sorted(all_items, key=lambda x: x['timestamp'], reverse=True)[:200]
+            # Query all stations via the time-ordered GSI (recent 200)
+            response = table.query(
+                IndexName=ALL_BY_TIME_INDEX,
+                KeyConditionExpression=Key('gsi_pk').eq(ALL_STATIONS_PK),
+                ScanIndexForward=False,  # Newest first
+                Limit=200,
+                ProjectionExpression=ITEM_PROJECTION
+            )
+            items = response.get('Items', [])
 
         # Process items: Add Presigned URL
-        for item in items:
-            if 's3_key' in item:
-                try:
-                    url = s3_client.generate_presigned_url(
-                        'get_object',
-                        Params={'Bucket': bucket_name, 'Key': item['s3_key']},
-                        ExpiresIn=3600
-                    )
-                    item['image_url'] = url
-                except ClientError:
-                    pass
+        keyed_items = [item for item in items if 's3_key' in item]
+        if keyed_items:
+            with ThreadPoolExecutor(max_workers=PRESIGN_WORKERS) as executor:
+                urls = executor.map(presign_url, (item['s3_key'] for item in keyed_items))
+                for item, url in zip(keyed_items, urls):
+                    if url:
+                        item['image_url'] = url
 
         return {
             'statusCode': 200,
             'headers': headers,
-            'body': json.dumps(items, cls=DecimalEncoder)
+            'body': orjson.dumps(items, default=decimal_default).decode()
         }
     except Exception as e:
         print(e)
@@ -8,6 +8,10 @@ import os
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger()
 
+# Same pattern as lambda_function.py
+REGEX_PATTERN = r'Station[^\S\n]*ID:[^\S\n]*(\w+)[^\S\n]+(\d{2}/\d{2}/\d{4}[^\S\n]+\d{4})[^\S\n]+UTC'
+_STATION_RE = re.compile(REGEX_PATTERN)
+
 
 def debug_rekognition(image_path, profile='sailvue', region='us-east-1'):
     """
@@ -45,16 +49,13 @@ def debug_rekognition(image_path, profile='sailvue', region='us-east-1'):
                 print(f"  Line {i}: '{item['DetectedText']}' (Confidence: {item['Confidence']:.2f}%)")
 
         print("\n=== 2. Regex Testing ===")
-        # Your current regex from lambda_function.py
-        # Note: Using raw string r'' to match python syntax
-        regex_pattern = r'Station ID:\s*(\w+)\s+(\d{2}/\d{2}/\d{4}\s+\d{4})\s+UTC'
-        print(f"Regex Pattern: {regex_pattern}")
+        print(f"Regex Pattern: {REGEX_PATTERN}")
 
         match_found = False
         for item in detections:
             if item['Type'] == 'LINE':
                 text = item['DetectedText']
-                match = re.search(regex_pattern, text)
+                match = _STATION_RE.search(text)
                 if match:
                     print(f"\n✅ MATCH FOUND in line: '{text}'")
                     print(f"   Group 1 (Station ID): '{match.group(1)}'")
@@ -1,20 +1,72 @@
 # aws/lambda_function.py
 import json
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
 import requests
 import hashlib
+import io
 import re
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 
+try:
+    from PIL import Image
+except ImportError:  # Pillow missing: Rekognition gets the full image
+    Image = None
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
-rekognition_client = boto3.client('rekognition')
-dynamodb = boto3.resource('dynamodb')
+# Shared client config: pool sized above MAX_WORKERS so station threads don't wait on connections
+boto_config = Config(
+    max_pool_connections=50,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+
+s3_client = boto3.client('s3', config=boto_config)
+rekognition_client = boto3.client('rekognition', config=boto_config)
+dynamodb = boto3.resource('dynamodb', config=boto_config)
+_deserializer = TypeDeserializer()
+
+# Shared HTTP session so NOAA requests reuse TCP/TLS connections across threads and warm invocations
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+# Stations are I/O-bound and independent; cap workers to avoid S3/Rekognition throttling
+MAX_WORKERS = 16
+
+# BatchWriteItem accepts at most 25 items per request
+BATCH_WRITE_SIZE = 25
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Height (px) of the bottom caption strip containing "Station ID: ... UTC"
+TEXT_BAND_HEIGHT = 80
+
+# Rekognition results keyed by image MD5; survives across warm container invocations
+_REKOG_CACHE = {}
+_REKOG_CACHE_MAX = 256
+
+# Constant partition key for the AllByTime GSI (all stations, newest first)
+ALL_STATIONS_PK = 'ALL'
+
+# Sort key of the per-station item tracking the last uploaded image (kept whether or not
+# meteo matched); '#' sorts before ISO timestamps so it stays out of timestamp range queries
+LATEST_TIMESTAMP = '#latest'
+
+# Match: "Station ID: 41009 11/18/2025 1610 UTC"
+# - Flexible whitespace around "Station ID", but never a newline: OCR lines are joined
+#   with '\n' and a match must stay within one line
+# - Capture groups for ID and Date/Time
+_STATION_RE = re.compile(r'Station[^\S\n]*ID:[^\S\n]*(\w+)[^\S\n]+(\d{2}/\d{2}/\d{4}[^\S\n]+\d{4})[^\S\n]+UTC')
+
+# Extracted image timestamp: "11/18/2025 1610" (MM/DD/YYYY HHMM)
+_TS_RE = re.compile(r'(\d\d)/(\d\d)/(\d{4})\s+(\d\d)(\d\d)')
 
 
 def lambda_handler(event, context):
@@ -40,105 +92,241 @@ def lambda_handler(event, context):
         return error_response('STATION_IDS environment variable not set')
     
     results = []
+    # Resources aren't thread-safe: the Table is only used here for the batch writer,
+    # worker threads read through dynamodb.meta.client instead
     table = dynamodb.Table(table_name)
     
-    for station_id in station_ids:
-        station_id = station_id.strip()
-        if not station_id:
-            continue
-            
-        try:
-            process_station(bucket_name, table, station_id)
-            results.append({'station_id': station_id, 'status': 'success'})
-        except Exception as e:
-            logger.error(f"Error processing station {station_id}: {str(e)}")
-            results.append({'station_id': station_id, 'status': 'error', 'message': str(e)})
+    station_ids = [sid.strip() for sid in station_ids if sid.strip()]
+    
+    # Records are collected on this thread as stations finish, then batch-written together
+    pending = []
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(station_ids)))) as executor:
+        futures = {
+            executor.submit(process_station, bucket_name, table_name, station_id): station_id
+            for station_id in station_ids
+        }
+        for future in as_completed(futures):
+            station_id = futures[future]
+            try:
+                record = future.result()
+                if record:
+                    save_to_dynamodb(pending, station_id, *record)
+                results.append({'station_id': station_id, 'status': 'success'})
+            except Exception as e:
+                logger.error(f"Error processing station {station_id}: {str(e)}")
+                results.append({'station_id': station_id, 'status': 'error', 'message': str(e)})
+    
+    write_to_dynamodb(table, pending, results)
     
     return {
         'statusCode': 200,
         'body': json.dumps({'message': 'Processing completed', 'results': results})
     }
 
+def write_to_dynamodb(table, pending, results):
+    """Batch-write queued (station_id, item) pairs; stations whose chunk fails are marked as errors."""
+    # One BatchWriter per chunk of at most one BatchWriteItem request, so a failed flush maps to
+    # exactly the stations in that chunk (a shared writer flushing every 25 items inside put_item
+    # lost track of them once more than 12 stations, at 2 items each, were queued)
+    for start in range(0, len(pending), BATCH_WRITE_SIZE):
+        chunk = pending[start:start + BATCH_WRITE_SIZE]
+        try:
+            # overwrite_by_pkeys dedups repeated keys (e.g. a station listed twice) within a request
+            with table.batch_writer(overwrite_by_pkeys=['station_id', 'timestamp']) as batch:
+                for _, item in chunk:
+                    batch.put_item(Item=item)
+        except Exception as e:
+            failed = {station_id for station_id, _ in chunk}
+            logger.error(f"Error writing records to DynamoDB for {sorted(failed)}: {str(e)}")
+            for result in results:
+                if result['station_id'] in failed and result['status'] == 'success':
+                    result.update({'status': 'error', 'message': f"DynamoDB write failed: {str(e)}"})
+
 def error_response(message):
     return {'statusCode': 500, 'body': json.dumps(message)}
 
-def process_station(bucket_name, table, station_id):
-    # 1. Download and process image
-    image_data = download_and_process_image(bucket_name, station_id)
-    
-    # If duplicate or error, we stop here for this station
-    if not image_data or image_data.get('status') == 'skipped':
-        return
+def process_station(bucket_name, table_name, station_id):
+    """Process one station; returns (image_data, meteo_data) to save, or None if skipped."""
+    # 1. Download image and check deduplication
+    downloaded = download_image(table_name, station_id)
+
+    # If duplicate, we stop here for this station
+    if downloaded.get('status') == 'skipped':
+        return None
+
+    # 2. New image: fetch the metadata file in the background while the image is OCR'd and uploaded
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        metadata_future = executor.submit(fetch_metadata_file, station_id)
+        image_data = process_image(bucket_name, station_id, downloaded)
+        metadata_text = metadata_future.result()
 
-    # 2. Download raw metadata file to S3 (archival)
-    metadata_text = download_metadata_file(bucket_name, station_id)
+    # 3. Save raw metadata file to S3 (archival)
+    if metadata_text:
+        archive_metadata_file(bucket_name, station_id, metadata_text)
     
-    # 3. Parse metadata and find matching row
+    # 4. Parse metadata and find matching row
     extracted_time = image_data.get('extracted_info', {}).get('time')
     meteo_data = {}
     
     if extracted_time and metadata_text:
         meteo_data = find_matching_meteo_data(metadata_text, extracted_time)
     
-    # 4. Save combined record to DynamoDB
-    save_to_dynamodb(table, station_id, image_data, meteo_data)
+    # 5. Combined record is saved to DynamoDB by the caller's batch writer
+    return image_data, meteo_data
 
 
-def get_latest_image_hash(bucket_name, station_id):
-    """Retrieve the ETag (MD5) of the most recent image for the station."""
+def get_latest_image_record(table_name, station_id):
+    """Retrieve the MD5, ETag, S3 key and extracted text of the most recent image for the station."""
+    # Called from worker threads: use the thread-safe low-level client, not the shared Table resource
+    client = dynamodb.meta.client
+    projection = 'image_md5, source_etag, s3_key, rekognition_data'
     try:
-        today = datetime.utcnow()
-        prefixes = [
-            f"images/{station_id}/{today.strftime('%Y/%m/%d')}/",
-            f"images/{station_id}/{(today - timedelta(days=1)).strftime('%Y/%m/%d')}/"
-        ]
-        
-        for prefix in prefixes:
-            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-            if 'Contents' in response:
-                sorted_contents = sorted(response['Contents'], key=lambda x: x['Key'])
-                return sorted_contents[-1]['ETag'].strip('"')
+        response = client.get_item(
+            TableName=table_name,
+            Key={'station_id': {'S': station_id}, 'timestamp': {'S': LATEST_TIMESTAMP}},
+            ProjectionExpression=projection
+        )
+        item = response.get('Item')
+
+        if not item:
+            # Stations not yet tracked: fall back to the newest saved record
+            response = client.query(
+                TableName=table_name,
+                KeyConditionExpression='station_id = :sid AND #ts > :latest',
+                ExpressionAttributeNames={'#ts': 'timestamp'},
+                ExpressionAttributeValues={':sid': {'S': station_id}, ':latest': {'S': LATEST_TIMESTAMP}},
+                ScanIndexForward=False,  # Newest first
+                Limit=1,
+                ProjectionExpression=projection
+            )
+            items = response.get('Items', [])
+            item = items[0] if items else None
+
+        if item:
+            return {key: _deserializer.deserialize(value) for key, value in item.items()}
     except Exception as e:
-        logger.warning(f"Could not retrieve latest hash for station {station_id}: {e}")
-    return None
+        logger.warning(f"Could not retrieve latest image for station {station_id}: {e}")
+    return {}
+
+
+def get_stored_extraction(bucket_name, record):
+    """Reuse text extracted from a previously stored image instead of re-running OCR."""
+    extracted = record.get('rekognition_data') or {}
+    if extracted.get('station') or extracted.get('time'):
+        return extracted.get('station'), extracted.get('time')
+
+    # Older records: fall back to the user metadata stored on the S3 object
+    if record.get('s3_key'):
+        try:
+            head = s3_client.head_object(Bucket=bucket_name, Key=record['s3_key'])
+            metadata = head.get('Metadata', {})
+            return metadata.get('extracted_id'), metadata.get('extracted_time')
+        except Exception as e:
+            logger.warning(f"Could not read metadata for {record['s3_key']}: {e}")
+    return None, None
 
 
-def extract_image_data(image_bytes, station_id):
-    """Extract Station ID and Timestamp from image using Rekognition."""
+def crop_text_band(image_bytes):
+    """Crop the caption strip holding the station header, re-encoded as JPEG."""
+    if Image is None:
+        return None
     try:
-        response = rekognition_client.detect_text(Image={'Bytes': image_bytes})
-        for item in response['TextDetections']:
-            if item['Type'] == 'LINE':
-                # Match: "Station ID: 41009 11/18/2025 1610 UTC"
-                # Improved regex:
-                # - r'' raw string for clarity
-                # - Flexible whitespace around "Station ID"
-                # - Capture groups for ID and Date/Time
-                match = re.search(r'Station\s*ID:\s*(\w+)\s+(\d{2}/\d{2}/\d{4}\s+\d{4})\s+UTC', item['DetectedText'])
-                if match:
-                    return match.group(1), match.group(2)
+        with Image.open(io.BytesIO(image_bytes)) as im:
+            top = max(0, im.height - TEXT_BAND_HEIGHT)
+            band = im.crop((0, top, im.width, im.height)).convert('RGB')
+            buffer = io.BytesIO()
+            band.save(buffer, 'JPEG', quality=85)
+            return buffer.getvalue()
+    except Exception as e:
+        logger.warning(f"Could not crop text band: {e}")
+        return None
+
+
+def detect_station_header(image):
+    """Run Rekognition on the image (Bytes or S3Object) and match the station header line."""
+    response = rekognition_client.detect_text(Image=image)
+    # Search all detected lines in one pass rather than one regex call per line
+    text = '\n'.join(item['DetectedText'] for item in response['TextDetections'] if item['Type'] == 'LINE')
+    match = _STATION_RE.search(text)
+    if match:
+        return match.group(1), match.group(2)
+    return None, None
+
+
+def extract_image_data(image, station_id):
+    """Extract Station ID and Timestamp from image (Bytes or S3Object) using Rekognition."""
+    try:
+        return detect_station_header(image)
     except Exception as e:
         logger.warning(f"Failed to extract text from image for station {station_id}: {str(e)}")
     return None, None
 
 
-def download_and_process_image(bucket_name, station_id):
-    """Download image, check deduplication, extract text, upload to S3."""
+def download_image(table_name, station_id):
+    """Download image and check deduplication against the latest stored image."""
     image_url = f"https://www.ndbc.noaa.gov/buoycam.php?station={station_id}"
-    response = requests.get(image_url, timeout=30)
-    response.raise_for_status()
-    image_content = response.content
-
-    # Deduplication
     force_process = os.environ.get('FORCE_PROCESS', 'false').lower() == 'true'
-    current_md5 = hashlib.md5(image_content).hexdigest()
-    if not force_process and current_md5 == get_latest_image_hash(bucket_name, station_id):
+    latest = get_latest_image_record(table_name, station_id)
+
+    # Conditional GET: NOAA answers 304 when the image behind the last ETag is unchanged
+    headers = {}
+    if not force_process and latest.get('source_etag'):
+        headers['If-None-Match'] = latest['source_etag']
+
+    # Stream the body, hashing each chunk as it arrives
+    md5 = hashlib.md5()
+    buffer = io.BytesIO()
+    with http_session.get(image_url, headers=headers, timeout=30, stream=True) as response:
+        if response.status_code == 304:
+            logger.info(f"Image not modified for station {station_id}")
+            return {'status': 'skipped'}
+        response.raise_for_status()
+        source_etag = response.headers.get('ETag')
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            md5.update(chunk)
+            buffer.write(chunk)
+    image_content = buffer.getvalue()
+
+    # Deduplication (servers without ETag support always return the body)
+    current_md5 = md5.hexdigest()
+    is_duplicate = current_md5 == latest.get('image_md5')
+    if not force_process and is_duplicate:
         logger.info(f"Skipping duplicate image for station {station_id}")
         return {'status': 'skipped'}
 
-    # Text Extraction
-    extracted_id, extracted_timestamp = extract_image_data(image_content, station_id)
-    
+    return {
+        'status': 'downloaded',
+        'image_url': image_url,
+        'image_content': image_content,
+        'image_md5': current_md5,
+        'source_etag': source_etag,
+        'is_duplicate': is_duplicate,
+        'latest': latest
+    }
+
+
+def process_image(bucket_name, station_id, downloaded):
+    """Extract text from a new image and upload it to S3."""
+    image_url = downloaded['image_url']
+    image_content = downloaded['image_content']
+    current_md5 = downloaded['image_md5']
+
+    # Text Extraction (reuse earlier OCR of identical content when available)
+    cached = _REKOG_CACHE.get(current_md5)
+    if not cached and downloaded['is_duplicate']:
+        cached = get_stored_extraction(bucket_name, downloaded['latest'])
+        if not any(cached):
+            cached = None
+    if cached:
+        extracted_id, extracted_timestamp = cached
+    else:
+        # Send only the caption strip inline first
+        extracted_id, extracted_timestamp = None, None
+        band_bytes = crop_text_band(image_content)
+        if band_bytes:
+            extracted_id, extracted_timestamp = extract_image_data({'Bytes': band_bytes}, station_id)
+
     # Upload to S3
     timestamp = datetime.utcnow()
     s3_key = f"images/{station_id}/{timestamp.strftime('%Y/%m/%d')}/{timestamp.strftime('%Y%m%d_%H%M%S')}.jpg"
@@ -158,34 +346,71 @@ def download_and_process_image(bucket_name, station_id):
         ContentType='image/jpeg',
         Metadata=s3_metadata
     )
+
+    if not cached:
+        if not extracted_id:
+            # Band didn't match: Rekognition reads the full image from S3 rather than it being
+            # re-sent from Lambda. The result is kept in DynamoDB, not in the object's metadata.
+            extracted_id, extracted_timestamp = extract_image_data(
+                {'S3Object': {'Bucket': bucket_name, 'Name': s3_key}}, station_id
+            )
+        if extracted_id or extracted_timestamp:
+            if len(_REKOG_CACHE) >= _REKOG_CACHE_MAX:
+                _REKOG_CACHE.clear()
+            _REKOG_CACHE[current_md5] = (extracted_id, extracted_timestamp)
     
     return {
         'status': 'success',
         's3_key': s3_key,
+        'image_md5': current_md5,
+        'source_etag': downloaded['source_etag'],
         'download_timestamp': timestamp.isoformat(),
         'extracted_info': {'station': extracted_id, 'time': extracted_timestamp}
     }
 
 
-def download_metadata_file(bucket_name, station_id):
-    """Download metadata text file and save to S3."""
+def fetch_metadata_file(station_id):
+    """Download the NOAA 5-day metadata text file."""
     try:
         url = f"https://www.ndbc.noaa.gov/data/5day2/{station_id}_5day.txt"
-        response = requests.get(url, timeout=30)
+        response = http_session.get(url, timeout=30)
         response.raise_for_status()
-        
+        return response.text
+    except Exception as e:
+        logger.error(f"Error downloading metadata file: {e}")
+        return None
+
+
+def archive_metadata_file(bucket_name, station_id, metadata_text):
+    """Save raw metadata text file to S3."""
+    try:
         timestamp = datetime.utcnow()
         s3_key = f"metadata/{station_id}/{timestamp.strftime('%Y/%m/%d')}/{timestamp.strftime('%Y%m%d_%H%M%S')}.txt"
         
         s3_client.put_object(
             Bucket=bucket_name,
             Key=s3_key,
-            Body=response.text,
+            Body=metadata_text,
             ContentType='text/plain'
         )
-        return response.text
     except Exception as e:
-        logger.error(f"Error downloading metadata file: {e}")
+        logger.error(f"Error archiving metadata file: {e}")
+
+
+def parse_image_timestamp(timestamp_str):
+    """Parse an extracted image timestamp ("11/18/2025 1610") into a datetime."""
+    match = _TS_RE.fullmatch(timestamp_str)
+    if not match:
+        raise ValueError(f"Unrecognized image timestamp: {timestamp_str!r}")
+    month, day, year, hour, minute = map(int, match.groups())
+    return datetime(year, month, day, hour, minute)
+
+
+def parse_meteo_timestamp(parts):
+    """Parse the leading YYYY MM DD hh mm columns of a NOAA 5-day line."""
+    try:
+        return datetime(int(parts[0]), int(parts[1]), int(parts[2]), int(parts[3]), int(parts[4]))
+    except (ValueError, IndexError):
         return None
 
 
@@ -196,9 +421,8 @@ def parse_meteo_line(line):
     
     # Header: #YY MM DD hh mm WDIR WSPD GST WVHT DPD APD MWD PRES ATMP WTMP DEWP VIS PTDY TIDE
     try:
-        # Parse timestamp: YYYY MM DD hh mm
-        dt_str = f"{parts[0]} {parts[1]} {parts[2]} {parts[3]} {parts[4]}"
-        dt = datetime.strptime(dt_str, "%Y %m %d %H %M")
+        dt = parse_meteo_timestamp(parts)
+        if dt is None: return None
         
         # Map rest of the fields (handling 'MM' as None/null)
         def get_val(idx):
@@ -232,7 +456,7 @@ def find_matching_meteo_data(metadata_text, image_timestamp_str):
     """Find ALL meteo data rows matching image timestamp within +/- 30 mins."""
     try:
         # Parse image timestamp (format: 11/18/2025 1610)
-        img_time = datetime.strptime(image_timestamp_str, "%m/%d/%Y %H%M")
+        img_time = parse_image_timestamp(image_timestamp_str)
 
         # Use splitlines() to handle different line endings safely
         lines = metadata_text.strip().splitlines()
@@ -242,13 +466,23 @@ def find_matching_meteo_data(metadata_text, image_timestamp_str):
         matching_records = []
 
         for line in data_lines:
-            record = parse_meteo_line(line)
-            if not record: continue
+            # Check the timestamp columns first; only fully parse lines in the window
+            record_time = parse_meteo_timestamp(line.split(None, 5))
+            if not record_time: continue
 
             # Calculate difference in minutes
-            diff = abs((record['timestamp'] - img_time).total_seconds() / 60)
+            delta = (record_time - img_time).total_seconds() / 60
+
+            # File is sorted newest-first, so nothing further down can match
+            if delta < -30:
+                break
 
-            if diff <= 30:
+            diff = abs(delta)
+            if diff > 30:
+                continue
+
+            record = parse_meteo_line(line)
+            if record:
                 meteo_entry = record['data']
                 meteo_entry['meteo_timestamp'] = record['timestamp'].isoformat()
                 meteo_entry['time_diff_minutes'] = f"{diff:.1f}"
@@ -261,8 +495,21 @@ def find_matching_meteo_data(metadata_text, image_timestamp_str):
         return []
 
 
-def save_to_dynamodb(table, station_id, image_data, meteo_data):
-    """Save combined record to DynamoDB."""
+def save_to_dynamodb(pending, station_id, image_data, meteo_data):
+    """Queue combined record for the DynamoDB batch write in lambda_handler."""
+
+    # Track every uploaded image for deduplication, even when no meteo record is saved
+    latest_item = {
+        'station_id': station_id,
+        'timestamp': LATEST_TIMESTAMP,
+        's3_key': image_data['s3_key'],
+        'image_md5': image_data['image_md5'],
+        'rekognition_data': image_data.get('extracted_info', {}),
+        'created_at': datetime.utcnow().isoformat()
+    }
+    if image_data.get('source_etag'):
+        latest_item['source_etag'] = image_data['source_etag']
+    pending.append((station_id, latest_item))
     
     # Primary timestamp source: Extracted from image. 
     # Fallback: Download timestamp.
@@ -271,7 +518,7 @@ def save_to_dynamodb(table, station_id, image_data, meteo_data):
     if extracted_time_str:
         try:
             # Convert "11/18/2025 1610" to ISO8601 for sorting
-            dt = datetime.strptime(extracted_time_str, "%m/%d/%Y %H%M")
+            dt = parse_image_timestamp(extracted_time_str)
             timestamp_iso = dt.isoformat()
         except ValueError:
             timestamp_iso = image_data['download_timestamp']
@@ -282,8 +529,14 @@ def save_to_dynamodb(table, station_id, image_data, meteo_data):
         'station_id': station_id,
         'timestamp': timestamp_iso,
         's3_key': image_data['s3_key'],
+        'image_md5': image_data['image_md5'],
+        'gsi_pk': ALL_STATIONS_PK,
         'created_at': datetime.utcnow().isoformat()
     }
+
+    if image_data.get('source_etag'):
+        item['source_etag'] = image_data['source_etag']
+
     
     if len(meteo_data) > 0:
         # DynamoDB requires Decimal for floats, but 'MM' is handled as None
@@ -295,7 +548,7 @@ def save_to_dynamodb(table, station_id, image_data, meteo_data):
         if image_data.get('extracted_info'):
             item['rekognition_data'] = image_data['extracted_info']
 
-        table.put_item(Item=item)
-        logger.info(f"Saved record to DynamoDB for {station_id} at {timestamp_iso} {item}")
+        pending.append((station_id, item))
+        logger.info(f"Queued record for DynamoDB for {station_id} at {timestamp_iso} {item}")
     else:
         logger.info(f"No meteo data found for {station_id} at {timestamp_iso}, skipping DynamoDB save.")
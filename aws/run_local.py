@@ -1,6 +1,9 @@
 import os
 import sys
 import boto3
+import argparse
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
 import time
 import logging
 
@@ -17,6 +20,10 @@ REGION = "us-east-1"
 TABLE_NAME = "noaa-buoycams-metadata"
 BUCKET_PREFIX = "noaa-buoycams-data"
 STATION_IDS = "41009,42036,42003"  # Test with a few stations
+ALL_STATIONS_PK = "ALL"  # Must match lambda_function.ALL_STATIONS_PK
+LATEST_TIMESTAMP = "#latest"  # Must match lambda_function.LATEST_TIMESTAMP
+# Keyed by profile/region so switching accounts never reuses another account's bucket
+BUCKET_CACHE_FILE = os.path.expanduser(f"~/.cache/buoycams/bucket-{PROFILE}-{REGION}")
 
 
 def setup_environment():
@@ -48,7 +55,18 @@ def ensure_dynamodb_table(session):
             ],
             AttributeDefinitions=[
                 {'AttributeName': 'station_id', 'AttributeType': 'S'},
-                {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+                {'AttributeName': 'timestamp', 'AttributeType': 'S'},
+                {'AttributeName': 'gsi_pk', 'AttributeType': 'S'}
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'AllByTime',
+                    'KeySchema': [
+                        {'AttributeName': 'gsi_pk', 'KeyType': 'HASH'},
+                        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'}
+                }
             ],
             BillingMode='PAY_PER_REQUEST'
         )
@@ -59,20 +77,96 @@ def ensure_dynamodb_table(session):
     return TABLE_NAME
 
 
+def read_cached_bucket(s3):
+    """Return the bucket name resolved by a previous run for this profile, if it still exists"""
+    cached = os.environ.get('S3_BUCKET_NAME_CACHED')
+    if not cached:
+        try:
+            with open(BUCKET_CACHE_FILE) as f:
+                cached = f.read().strip()
+        except OSError:
+            return None
+
+    if not cached or not cached.startswith(BUCKET_PREFIX):
+        return None
+
+    # Confirm the bucket is still there and reachable (stack redeployed, credentials changed)
+    try:
+        s3.head_bucket(Bucket=cached)
+    except Exception as e:
+        logger.info(f"Cached S3 Bucket {cached} not usable ({e}), looking it up again")
+        return None
+    return cached
+
+
+def write_cached_bucket(bucket_name):
+    """Remember the resolved bucket name for later runs"""
+    os.environ['S3_BUCKET_NAME_CACHED'] = bucket_name
+    try:
+        os.makedirs(os.path.dirname(BUCKET_CACHE_FILE), exist_ok=True)
+        with open(BUCKET_CACHE_FILE, 'w') as f:
+            f.write(bucket_name)
+    except OSError as e:
+        logger.warning(f"Could not write bucket cache {BUCKET_CACHE_FILE}: {e}")
+
+
 def find_s3_bucket(session):
     """Find the S3 bucket created by the stack"""
     s3 = session.client('s3')
+    cached = read_cached_bucket(s3)
+    if cached:
+        logger.info(f"Using cached S3 Bucket: {cached}")
+        return cached
+
     response = s3.list_buckets()
 
     for bucket in response['Buckets']:
         if bucket['Name'].startswith(BUCKET_PREFIX):
             logger.info(f"Found S3 Bucket: {bucket['Name']}")
+            write_cached_bucket(bucket['Name'])
             return bucket['Name']
 
     logger.error(f"Could not find bucket starting with {BUCKET_PREFIX}")
     sys.exit(1)
 
 
+def backfill_gsi_pk(session):
+    """One-off migration: add gsi_pk to records written before the AllByTime index existed"""
+    table = session.resource('dynamodb').Table(TABLE_NAME)
+    scan_kwargs = {
+        'FilterExpression': Attr('gsi_pk').not_exists(),
+        'ProjectionExpression': 'station_id, #ts',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'}
+    }
+
+    updated = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            # Skip the downloader's per-station dedup item; it isn't a data record
+            if item['timestamp'] == LATEST_TIMESTAMP:
+                continue
+            try:
+                table.update_item(
+                    Key={'station_id': item['station_id'], 'timestamp': item['timestamp']},
+                    UpdateExpression='SET gsi_pk = :pk',
+                    ConditionExpression='attribute_exists(station_id)',
+                    ExpressionAttributeValues={':pk': ALL_STATIONS_PK}
+                )
+                updated += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # Deleted since the scan; nothing to backfill
+                logger.warning(f"Skipping {item['station_id']} {item['timestamp']}: record no longer exists")
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    logger.info(f"Backfilled gsi_pk on {updated} records in '{TABLE_NAME}'.")
+
+
 def main():
     session = setup_environment()
 
@@ -119,4 +213,12 @@ def main():
 if __name__ == "__main__":
     import json
 
-    main()
+    parser = argparse.ArgumentParser(description='Run the downloader Lambda locally')
+    parser.add_argument('--backfill-gsi', action='store_true',
+                        help='Add gsi_pk to existing records (run once after deploying the AllByTime index)')
+    args = parser.parse_args()
+
+    if args.backfill_gsi:
+        backfill_gsi_pk(setup_environment())
+    else:
+        main()